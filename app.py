@@ -1,10 +1,22 @@
 import streamlit as st
 import openai
 import os
+import asyncio
 from dotenv import load_dotenv
-import tempfile
-import json
+import io
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import hashlib
+import functools
+import itertools
+import shelve
+import dbm
+import uuid
+import numpy as np
+import tiktoken
 from pptx import Presentation
+from pptx.enum.shapes import MSO_SHAPE_TYPE
 
 # Load environment variables
 load_dotenv()
@@ -23,183 +35,227 @@ if "document_content" not in st.session_state:
     st.session_state.document_content = ""
 if "api_key" not in st.session_state:
     st.session_state.api_key = ""
+if "slide_records" not in st.session_state:
+    st.session_state.slide_records = []
+if "slide_summaries" not in st.session_state:
+    st.session_state.slide_summaries = []
+if "document_cache" not in st.session_state:
+    st.session_state.document_cache = {}
+if "doc_tokens" not in st.session_state:
+    st.session_state.doc_tokens = 0
+if "slide_tokens" not in st.session_state:
+    st.session_state.slide_tokens = []
+if "document_hash" not in st.session_state:
+    st.session_state.document_hash = ""
+
+# Chat model used for all completions
+CHAT_MODEL = "gpt-4o-mini"
+# Documents above this many tokens are split into chunks (gpt-4o-mini has a 128k context window)
+CONTEXT_TOKEN_LIMIT = 100000
+# Maximum number of OpenAI requests in flight at once
+MAX_CONCURRENT_REQUESTS = 8
+# Token budget for each chunk of slides sent to the model
+CHUNK_TOKEN_BUDGET = 25000
+# Number of slide chunks analyzed in detail before falling back to summaries
+MAX_DETAILED_CHUNKS = 8
+# Embedding model used to match semantically similar questions
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Minimum cosine similarity for a cached response to be reused
+SEMANTIC_CACHE_THRESHOLD = 0.92
+# Number of processed documents kept per session for re-uploads
+DOCUMENT_CACHE_SIZE = 4
+# Maximum number of threads used to extract slide content
+MAX_EXTRACTION_WORKERS = 8
+# Include a DEBUG line for each shape with no extracted text
+DEBUG_PPTX = bool(os.environ.get("DEBUG_PPTX"))
+# Matches slide number mentions like "slide 15" in user questions
+SLIDE_NUMBER_RE = re.compile(r'slide\s+(\d+)', re.IGNORECASE)
+# Matches every number in a question, such as the ends of "slides 10-20"
+QUESTION_NUMBER_RE = re.compile(r'\d+')
 
 def get_openai_client(api_key):
-    """Initialize OpenAI client with the provided API key"""
+    """Initialize async OpenAI client with the provided API key"""
     if not api_key:
         return None
+    # Use the aiohttp transport, which holds up better than httpx under many concurrent requests
+    return openai.AsyncOpenAI(api_key=api_key, http_client=openai.DefaultAioHttpClient())
+
+async def _check_api_key(api_key):
+    """Test the API key by making a simple request"""
+    async with get_openai_client(api_key) as client:
+        await client.models.list()
+
+@st.cache_resource(show_spinner=False)
+def _check_api_key_once(api_key):
+    """Test each distinct API key only once; failures raise and are not cached"""
+    asyncio.run(_check_api_key(api_key))
+    return True
+
+def validate_api_key(api_key):
+    """Check that the API key can connect to the OpenAI API"""
+    if not api_key:
+        return False
     try:
-        client = openai.OpenAI(api_key=api_key)
-        # Test the API key by making a simple request
-        client.models.list()
-        return client
+        return _check_api_key_once(api_key)
     except Exception as e:
         st.error(f"Error connecting to OpenAI API: {str(e)}")
-        return None
+        return False
 
 def process_document(file_content, filename):
-    """Process the uploaded document and extract text content"""
+    """Process the uploaded document and extract text content and slide records"""
     try:
         if filename.endswith('.txt') or filename.endswith('.md'):
             # Handle text and markdown files
-            return file_content.decode('utf-8')
+            return file_content.decode('utf-8'), []
         elif filename.endswith('.pptx'):
             # Handle PowerPoint files
             return process_pptx_file(file_content)
         else:
             # For other file types, try to decode as text
-            return file_content.decode('utf-8')
+            return file_content.decode('utf-8'), []
     except Exception as e:
         st.error(f"Error processing document: {str(e)}")
-        return ""
+        return "", []
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def process_document_cached(content_hash, filename, _file_content):
+    """Process the document once per unique file content, reusing the result across reruns"""
+    return process_document(_file_content, filename)
 
 def process_pptx_file(file_content):
-    """Extract comprehensive text content from a PowerPoint file with enhanced extraction"""
+    """Extract comprehensive text content and slide records from a PowerPoint file"""
     try:
-        # Create a temporary file to save the PowerPoint content
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pptx') as temp_file:
-            temp_file.write(file_content)
-            temp_file_path = temp_file.name
-        
-        # Load the presentation
-        presentation = Presentation(temp_file_path)
-        
-        # Extract comprehensive content from all slides
-        extracted_content = []
-        total_slides = len(presentation.slides)
+        # Load the presentation directly from memory
+        presentation = Presentation(io.BytesIO(file_content))
         
-        for i, slide in enumerate(presentation.slides, 1):
-            slide_content = extract_slide_content(slide, i)
-            if slide_content:
-                extracted_content.append(slide_content)
+        # Extract comprehensive content from all slides in parallel
+        slides = list(presentation.slides)
+        total_slides = len(slides)
         
-        # Clean up temporary file
-        os.unlink(temp_file_path)
+        with ThreadPoolExecutor(max_workers=min(MAX_EXTRACTION_WORKERS, os.cpu_count() or 1)) as executor:
+            results = executor.map(extract_slide_content, slides, range(1, total_slides + 1))
+            slide_records = [record for record in results if record]
         
-        if not extracted_content:
-            return "No text content found in the PowerPoint file."
+        if not slide_records:
+            return "No text content found in the PowerPoint file.", []
         
         # Combine all slide content
-        full_content = "\n\n".join(extracted_content)
+        full_content = "\n\n".join(record.to_text() for record in slide_records)
         
         # Add presentation metadata
-        metadata = f"PRESENTATION OVERVIEW:\nTotal Slides: {total_slides}\nContent Extracted: {len(extracted_content)} slides\n\n"
+        metadata = f"PRESENTATION OVERVIEW:\nTotal Slides: {total_slides}\nContent Extracted: {len(slide_records)} slides\n\n"
         
-        return metadata + full_content
+        return metadata + full_content, slide_records
         
     except Exception as e:
         st.error(f"Error processing PowerPoint file: {str(e)}")
-        return ""
+        return "", []
+
+@dataclass
+class SlideRecord:
+    """Structured content extracted from a single slide"""
+    number: int
+    title: str = ""
+    content: list = field(default_factory=list)
+    tables: list = field(default_factory=list)
+    notes: str = ""
+    # Every extracted line, in slide order, as it appears in the document text
+    lines: list = field(default_factory=list)
+    
+    def to_text(self):
+        """Render the slide as a block of the extracted document"""
+        return "\n".join(itertools.chain((f"=== SLIDE {self.number} ===",), self.lines))
 
 def extract_slide_content(slide, slide_number):
-    """Extract comprehensive content from a single slide"""
-    slide_content = []
-    slide_content.append(f"=== SLIDE {slide_number} ===")
+    """Extract comprehensive content from a single slide into a SlideRecord"""
+    record = SlideRecord(number=slide_number)
     
-    # Extract slide notes if available
-    if hasattr(slide, 'notes_slide') and slide.notes_slide:
+    for content_type, text in _iter_slide_items(slide):
+        # Table text already starts with its own "TABLE:" header
+        if content_type and content_type != "TABLE":
+            record.lines.append(f"{content_type}: {text}")
+        else:
+            record.lines.append(text)
+        if content_type == "TITLE":
+            record.title = text
+        elif content_type == "CONTENT" or content_type == "TEXT":
+            record.content.append(text)
+        elif content_type == "TABLE":
+            record.tables.append(text)
+        elif content_type == "NOTES":
+            record.notes = text
+    
+    # Only return slide content if it has meaningful text
+    if record.lines:
+        return record
+    
+    return None
+
+def _iter_slide_items(slide):
+    """Yield (content type, text) pairs for a slide: notes first, then one per shape"""
+    # Extract slide notes if available (accessing notes_slide would create one, so check first)
+    if slide.has_notes_slide:
         notes_text = extract_text_from_shapes(slide.notes_slide.shapes)
-        if notes_text.strip():
-            slide_content.append(f"NOTES: {notes_text.strip()}")
+        if notes_text:
+            yield "NOTES", notes_text
     
     # Extract content from all shapes with detailed processing
-    shape_content = []
-    shape_count = 0
-    
-    for shape in slide.shapes:
-        shape_count += 1
+    for shape_count, shape in enumerate(slide.shapes, 1):
         shape_text = extract_text_from_shape(shape)
         
-        # Debug: Log shape information
-        shape_info = f"Shape {shape_count}: {type(shape).__name__}"
-        if hasattr(shape, 'name'):
-            shape_info += f" (name: {shape.name})"
-        if hasattr(shape, 'shape_type'):
-            shape_info += f" (type: {shape.shape_type})"
-        
-        if shape_text.strip():
+        if shape_text:
             # Determine content type based on shape properties
-            content_type = get_content_type(shape)
-            if content_type:
-                shape_content.append(f"{content_type}: {shape_text.strip()}")
-            else:
-                shape_content.append(shape_text.strip())
-        else:
+            yield get_content_type(shape), shape_text
+        elif DEBUG_PPTX:
             # Log shapes with no text for debugging
-            shape_content.append(f"DEBUG: {shape_info} - No text extracted")
-    
-    if shape_content:
-        slide_content.extend(shape_content)
-    
-    # Only return slide content if it has meaningful text
-    if len(slide_content) > 1:  # More than just the slide header
-        return "\n".join(slide_content)
-    
-    return None
+            shape_info = f"Shape {shape_count}: {type(shape).__name__}"
+            if hasattr(shape, 'name'):
+                shape_info += f" (name: {shape.name})"
+            if hasattr(shape, 'shape_type'):
+                shape_info += f" (type: {shape.shape_type})"
+            yield "DEBUG", f"{shape_info} - No text extracted"
 
-def extract_text_from_shape(shape):
-    """Extract text from a single shape with comprehensive handling"""
-    text_content = []
-    
+def _collect_shape_text(shape, out):
+    """Append the stripped, non-empty text of a shape to out, recursing into groups"""
     try:
-        # Handle different shape types - be more aggressive about text extraction
-        
-        # First, try to get any text from the shape
-        if hasattr(shape, 'text') and shape.text and shape.text.strip():
-            text_content.append(shape.text.strip())
-        
-        # Handle text frames (most common for detailed content)
-        if hasattr(shape, 'text_frame') and shape.text_frame:
-            frame_text = extract_text_frame_content(shape.text_frame)
-            if frame_text and frame_text.strip():
-                text_content.append(frame_text.strip())
-        
-        # Handle tables
-        if hasattr(shape, 'table') and shape.table:
-            table_text = extract_table_content(shape.table)
-            if table_text and table_text.strip():
-                text_content.append(table_text.strip())
-        
-        # Handle grouped shapes
-        if hasattr(shape, 'shapes') and shape.shapes:
-            group_text = extract_text_from_shapes(shape.shapes)
-            if group_text and group_text.strip():
-                text_content.append(group_text.strip())
-        
-        # Additional text extraction methods
-        if hasattr(shape, 'has_text_frame') and shape.has_text_frame:
-            try:
-                if shape.text_frame and shape.text_frame.text:
-                    text_content.append(shape.text_frame.text.strip())
-            except:
-                pass
-        
-        # Try to get text from any text-related attributes
-        for attr in ['text', 'content', 'value']:
-            if hasattr(shape, attr):
-                try:
-                    attr_value = getattr(shape, attr)
-                    if attr_value and str(attr_value).strip():
-                        text_content.append(str(attr_value).strip())
-                except:
-                    pass
+        # Text frames (most common for detailed content)
+        if shape.has_text_frame:
+            # Strip indentation of a leading bullet; tables come back already stripped
+            text = extract_text_frame_content(shape.text_frame).strip()
+        
+        # Tables
+        elif shape.has_table:
+            text = extract_table_content(shape.table)
+        
+        # Grouped shapes
+        elif shape.shape_type == MSO_SHAPE_TYPE.GROUP:
+            for child in shape.shapes:
+                _collect_shape_text(child, out)
+            return
+        
+        # Any other shape that exposes text
+        else:
+            text = (getattr(shape, 'text', '') or '').strip()
     
-    except Exception as e:
+    except Exception:
         # Continue processing other shapes if one fails
-        pass
+        return
     
-    # Join all text content and clean up
-    result = " ".join(text_content)
-    return result.strip() if result.strip() else ""
+    if text:
+        out.append(text)
+
+def extract_text_from_shape(shape):
+    """Extract text from a single shape, dispatching on the kind of shape"""
+    out = []
+    _collect_shape_text(shape, out)
+    return " ".join(out)
 
 def extract_text_from_shapes(shapes):
     """Extract text from a collection of shapes"""
-    text_parts = []
+    out = []
     for shape in shapes:
-        shape_text = extract_text_from_shape(shape)
-        if shape_text.strip():
-            text_parts.append(shape_text.strip())
-    return " ".join(text_parts)
+        _collect_shape_text(shape, out)
+    return " ".join(out)
 
 def extract_table_content(table):
     """Extract content from a table"""
@@ -227,177 +283,227 @@ def extract_text_frame_content(text_frame):
             para_text = paragraph.text.strip()
             if para_text:
                 # Check if this is a bullet point or special formatting
-                if hasattr(paragraph, 'level') and paragraph.level > 0:
+                if paragraph.level > 0:
                     indent = "  " * paragraph.level
                     frame_content.append(f"{indent}• {para_text}")
                 else:
                     frame_content.append(para_text)
-        
-        # Also try to get text from runs within paragraphs
-        for paragraph in text_frame.paragraphs:
-            if hasattr(paragraph, 'runs'):
-                for run in paragraph.runs:
-                    run_text = run.text.strip()
-                    if run_text and run_text not in frame_content:
-                        frame_content.append(run_text)
-        
-        # Try alternative text extraction
-        if hasattr(text_frame, 'text') and text_frame.text:
-            full_text = text_frame.text.strip()
-            if full_text and full_text not in frame_content:
-                frame_content.append(full_text)
     
-    except Exception as e:
+    except Exception:
         # If detailed extraction fails, try basic text extraction
         try:
-            if hasattr(text_frame, 'text') and text_frame.text:
-                frame_content.append(text_frame.text.strip())
-        except:
-            pass
+            frame_content = [text_frame.text.strip()]
+        except Exception:
+            frame_content = []
     
     return "\n".join(frame_content)
 
 def get_content_type(shape):
     """Determine the type of content based on shape properties"""
     try:
-        # Check if it's a title shape
-        if hasattr(shape, 'placeholder_format'):
-            if shape.placeholder_format.type == 1:  # Title placeholder
-                return "TITLE"
-            elif shape.placeholder_format.type == 2:  # Content placeholder
-                return "CONTENT"
-        
-        # Check shape name for hints
-        if hasattr(shape, 'name'):
-            name_lower = shape.name.lower()
-            if 'title' in name_lower:
-                return "TITLE"
-            elif 'content' in name_lower or 'body' in name_lower:
-                return "CONTENT"
-        
-        # Check if it's a table
-        if hasattr(shape, 'table'):
-            return "TABLE"
-        
-        # Check if it's a text box
-        if hasattr(shape, 'text_frame') and not hasattr(shape, 'table'):
-            return "TEXT"
-        
+        placeholder_type = shape.placeholder_format.type if shape.is_placeholder else None
+        # Drop the per-shape number from names like "TextBox 17" so the memo key repeats across shapes
+        name_stem = shape.name.lower().rstrip("0123456789 ")
+        return _classify_shape(placeholder_type, name_stem, shape.has_table, shape.has_text_frame)
     except Exception:
-        pass
+        return None
+
+@functools.lru_cache(maxsize=512)
+def _classify_shape(placeholder_type, name_stem, has_table, has_text_frame):
+    """Classify a shape from its key properties; shapes repeat these heavily across a deck"""
+    # Check if it's a title shape
+    if placeholder_type == 1:  # Title placeholder
+        return "TITLE"
+    elif placeholder_type == 2:  # Content placeholder
+        return "CONTENT"
+    
+    # Check shape name for hints
+    if 'title' in name_stem:
+        return "TITLE"
+    elif 'content' in name_stem or 'body' in name_stem:
+        return "CONTENT"
+    
+    # Check if it's a table
+    if has_table:
+        return "TABLE"
+    
+    # Check if it's a text box
+    if has_text_frame:
+        return "TEXT"
     
     return None
 
-def estimate_tokens(text):
-    """Rough estimation of tokens (1 token ≈ 4 characters)"""
-    return len(text) // 4
+@st.cache_resource(show_spinner=False)
+def get_token_encoding():
+    """Load the tokenizer for the chat model once per process, or None if it can't be loaded"""
+    # tiktoken downloads the encoding on first use; cache the failure too so an
+    # unreachable host isn't retried for every slide
+    try:
+        return tiktoken.encoding_for_model(CHAT_MODEL)
+    except Exception:
+        return None
 
-def create_slide_summaries(document_content):
+def count_tokens(text):
+    """Count the tokens in the text using the chat model's tokenizer"""
+    encoding = get_token_encoding()
+    if encoding is None:
+        # Roughly four characters per token when the tokenizer is unavailable
+        return len(text) // 4
+    # Treat special-token markers in documents as plain text
+    return len(encoding.encode(text, disallowed_special=()))
+
+def create_slide_summaries(slide_records):
     """Create summaries for each slide to reduce token usage"""
-    slides = document_content.split("=== SLIDE")
-    summaries = []
-    
-    for i, slide_content in enumerate(slides[1:], 1):  # Skip first empty split
-        # Extract key information from each slide
-        lines = slide_content.strip().split('\n')
-        title = ""
-        key_points = []
-        
-        for line in lines:
-            if line.startswith("TITLE:"):
-                title = line.replace("TITLE:", "").strip()
-            elif line.startswith("CONTENT:") or line.startswith("TEXT:"):
-                content = line.split(":", 1)[1].strip()
-                if len(content) > 100:
-                    content = content[:100] + "..."
-                key_points.append(content)
-            elif line.startswith("TABLE:"):
-                key_points.append("Contains table data")
-        
-        # Create slide summary
-        summary = f"Slide {i}: {title}" if title else f"Slide {i}"
-        if key_points:
-            summary += f" - Key points: {'; '.join(key_points[:3])}"  # Limit to 3 key points
-        
-        summaries.append(summary)
+    return [summarize_slide(record) for record in slide_records]
+
+def summarize_slide(record):
+    """Summarize a slide from its title and up to three key points"""
+    key_points = []
+    for text in record.content[:3]:
+        point = text.split('\n', 1)[0]
+        if len(point) > 100:
+            point = point[:100] + "..."
+        key_points.append(point)
+    key_points.extend(["Contains table data"] * min(len(record.tables), 3 - len(key_points)))
+    
+    title = record.title.split('\n', 1)[0]
+    summary = f"Slide {record.number}: {title}" if title else f"Slide {record.number}"
+    if key_points:
+        summary += f" - Key points: {'; '.join(key_points)}"
     
-    return summaries
+    return summary
 
-def get_relevant_slides(document_content, user_message):
-    """Extract relevant slides based on user query"""
-    import re
+def pack_slide_chunks(slides, slide_token_counts, token_budget=CHUNK_TOKEN_BUDGET):
+    """Group consecutive slides into chunks that fit within the token budget
     
+    Returns the chunk texts and the number of slides in each chunk.
+    """
+    chunks = []
+    chunk_slide_counts = []
+    current = []
+    current_tokens = 0
+    
+    for slide, slide_tokens in zip(slides, slide_token_counts):
+        if current and current_tokens + slide_tokens > token_budget:
+            chunks.append("\n\n".join(current))
+            chunk_slide_counts.append(len(current))
+            current = []
+            current_tokens = 0
+        current.append(slide)
+        current_tokens += slide_tokens
+    
+    if current:
+        chunks.append("\n\n".join(current))
+        chunk_slide_counts.append(len(current))
+    
+    return chunks, chunk_slide_counts
+
+def get_relevant_slides(slide_records, slide_summaries, slide_tokens, user_message):
+    """Extract relevant slides based on user query, split into chunks for the model"""
     # Look for slide number mentions in the user message
-    slide_numbers = re.findall(r'slide\s+(\d+)', user_message.lower())
+    slide_numbers = SLIDE_NUMBER_RE.findall(user_message)
     
     if slide_numbers:
-        # Extract specific slides mentioned
-        slides = document_content.split("=== SLIDE")
+        # Extract specific slides mentioned, by their number in the presentation
+        records_by_number = {record.number: record for record in slide_records}
         relevant_content = []
         
         for slide_num in slide_numbers:
-            slide_index = int(slide_num)
-            # Adjust for 0-based indexing and ensure we have the slide
-            if slide_index > 0 and slide_index < len(slides):
-                slide_content = slides[slide_index]
-                relevant_content.append(f"=== SLIDE{slide_content}")
+            record = records_by_number.get(int(slide_num))
+            if record:
+                relevant_content.append(record.to_text())
         
         if relevant_content:
-            return "\n\n".join(relevant_content)
-    
-    # If no specific slides mentioned, return first few slides and summary
-    slides = document_content.split("=== SLIDE")
-    if len(slides) > 1:
-        # Return first 5 slides + summary of the rest
-        first_slides = slides[1:6]  # First 5 slides
-        remaining_slides = slides[6:] if len(slides) > 6 else []
-        
-        content_parts = [f"=== SLIDE{slide}" for slide in first_slides]
-        
-        if remaining_slides:
-            summaries = create_slide_summaries(document_content)
-            content_parts.append(f"\nSUMMARY OF REMAINING SLIDES:\n" + "\n".join(summaries[5:]))
-        
-        return "\n\n".join(content_parts)
+            return ["\n\n".join(relevant_content)]
+    
+    # If no specific slides mentioned, chunk the slides and summarize the rest
+    chunks, chunk_slide_counts = pack_slide_chunks([record.to_text() for record in slide_records], slide_tokens)
+    detailed_chunks = chunks[:MAX_DETAILED_CHUNKS]
+    
+    if len(chunks) > MAX_DETAILED_CHUNKS:
+        # Summarize the slides that didn't fit into the detailed chunks
+        covered_slides = sum(chunk_slide_counts[:MAX_DETAILED_CHUNKS])
+        detailed_chunks.append("SUMMARY OF REMAINING SLIDES:\n" + "\n".join(slide_summaries[covered_slides:]))
     
-    return document_content
+    return detailed_chunks
 
-def chat_with_ai(client, user_message, document_context=""):
-    """Send a message to OpenAI with smart content management for large presentations"""
-    try:
-        system_prompt = "You are a helpful AI assistant specialized in analyzing presentations and documents. "
-        
-        if document_context:
-            # Check token count and implement smart chunking
-            estimated_tokens = estimate_tokens(document_context)
-            
-            if estimated_tokens > 12000:  # Conservative limit for gpt-3.5-turbo
-                # Use smart content selection
-                relevant_content = get_relevant_slides(document_context, user_message)
-                
-                system_prompt += "The user has uploaded a large presentation. "
-                system_prompt += "You have access to relevant slide content based on their question. "
-                system_prompt += "If they ask about specific slides, provide detailed information from those slides. "
-                system_prompt += "If they ask general questions, provide a comprehensive overview based on the available content.\n\n"
-                system_prompt += f"RELEVANT PRESENTATION CONTENT:\n{relevant_content}\n\n"
-                
-                # Add note about full presentation
-                system_prompt += "NOTE: This is a large presentation. If you need information from other slides, ask the user to specify which slides they're interested in.\n\n"
-                
-                # Add debugging info for development
-                if "slide" in user_message.lower():
-                    system_prompt += "IMPORTANT: The user is asking about a specific slide. Make sure to provide comprehensive details from the slide content above. Look for all text, tables, and content within that slide.\n\n"
+@st.cache_data(show_spinner=False, max_entries=64)
+def get_relevant_slides_cached(document_hash, user_message, _slide_records, _slide_summaries, _slide_tokens):
+    """Select relevant slides once per document and question"""
+    return get_relevant_slides(_slide_records, _slide_summaries, _slide_tokens, user_message)
+
+def hash_document(document_content):
+    """Compute a short stable hash identifying the document content"""
+    return hashlib.blake2b(document_content.encode('utf-8'), digest_size=16).hexdigest()
+
+class SemanticCache:
+    """Cache of AI responses keyed on the document, the slides asked about, and the meaning of the question"""
+    
+    def __init__(self, path=None):
+        # Maps entry key -> (matrix of normalized question embeddings, list of responses)
+        self.entries = {}
+        self.path = path
+        if path and dbm.whichdb(path) is not None:
+            # Load responses persisted by earlier sessions; the cache still works in memory if this fails
+            try:
+                with shelve.open(path, flag='r') as db:
+                    persisted = {}
+                    for record_key, (embedding, response) in db.items():
+                        persisted.setdefault(record_key.rsplit(":", 1)[0], []).append((embedding, response))
+            except (OSError, dbm.error) as e:
+                st.warning(f"Could not load the response cache from {path}: {str(e)}")
             else:
-                system_prompt += f"Here is the content from the user's uploaded document:\n{document_context}\n\n"
-            
-            system_prompt += "Please provide detailed, accurate responses about the document content. "
-            system_prompt += "When referencing specific slides, mention the slide number. "
-            system_prompt += "If asked about specific details, provide comprehensive information from the relevant slides."
+                for key, records in persisted.items():
+                    embeddings, responses = zip(*records)
+                    self.entries[key] = (np.vstack(embeddings), list(responses))
+    
+    @staticmethod
+    def entry_key(document_hash, question_numbers):
+        """Build the key for a document and the numbers mentioned in a question"""
+        # Questions about different slides or ranges must never share answers, however similar they read
+        return f"{document_hash}:{','.join(str(int(number)) for number in question_numbers)}"
+    
+    def _add(self, key, embedding, response):
+        """Append a question embedding and its response to the in-memory entry"""
+        if key in self.entries:
+            embeddings, responses = self.entries[key]
+            self.entries[key] = (np.vstack([embeddings, embedding]), responses + [response])
         else:
-            system_prompt += "Please help the user with their questions."
+            self.entries[key] = (embedding[np.newaxis, :], [response])
+    
+    def lookup(self, document_hash, question_numbers, embedding):
+        """Return the cached response for the most similar question, if similar enough"""
+        entry = self.entries.get(self.entry_key(document_hash, question_numbers))
+        if entry is None:
+            return None
+        
+        embeddings, responses = entry
+        # Embeddings are L2-normalized, so the dot product is the cosine similarity
+        similarities = embeddings @ embedding
+        best = int(np.argmax(similarities))
+        if similarities[best] > SEMANTIC_CACHE_THRESHOLD:
+            return responses[best]
+        return None
+    
+    def insert(self, document_hash, question_numbers, embedding, response):
+        """Add a question embedding and its response to the cache"""
+        key = self.entry_key(document_hash, question_numbers)
+        self._add(key, embedding, response)
         
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
+        if self.path:
+            # Store each response under its own record so sessions sharing the file never overwrite each other
+            try:
+                with shelve.open(self.path) as db:
+                    db[f"{key}:{uuid.uuid4().hex}"] = (embedding, response)
+            except (OSError, dbm.error):
+                # Persistence is best effort; the response is already cached for this session
+                pass
+
+async def _complete(client, semaphore, system_prompt, user_message):
+    """Send a single chat completion request, limited by the shared semaphore"""
+    async with semaphore:
+        response = await client.chat.completions.create(
+            model=CHAT_MODEL,
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_message}
@@ -405,10 +511,183 @@ def chat_with_ai(client, user_message, document_context=""):
             max_tokens=1500,
             temperature=0.7
         )
+    return response.choices[0].message.content
+
+async def _stream_complete(client, semaphore, system_prompt, user_message):
+    """Stream a chat completion, yielding pieces of the response as they arrive"""
+    async with semaphore:
+        stream = await client.chat.completions.create(
+            model=CHAT_MODEL,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_message}
+            ],
+            max_tokens=1500,
+            temperature=0.7,
+            stream=True
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+async def _map_reduce_chunks(client, semaphore, user_message, chunks):
+    """Ask the question against each chunk concurrently, then stream the combined answer"""
+    total_chunks = len(chunks)
+    
+    async def _call(index, chunk):
+        chunk_prompt = "You are a helpful AI assistant specialized in analyzing presentations and documents. "
+        chunk_prompt += f"The user has uploaded a large presentation. You are reviewing part {index} of {total_chunks}. "
+        chunk_prompt += "Answer the user's question using only the content below, mentioning slide numbers where relevant. "
+        chunk_prompt += "If this part contains nothing relevant, reply with 'No relevant content.'\n\n"
+        chunk_prompt += f"PRESENTATION CONTENT:\n{chunk}"
+        return await _complete(client, semaphore, chunk_prompt, user_message)
+    
+    tasks = [asyncio.create_task(_call(i, chunk)) for i, chunk in enumerate(chunks, 1)]
+    partial_answers = await asyncio.gather(*tasks)
+    
+    findings = "\n\n".join(
+        f"PART {i}:\n{answer}" for i, answer in enumerate(partial_answers, 1)
+    )
+    
+    system_prompt = "You are a helpful AI assistant specialized in analyzing presentations and documents. "
+    system_prompt += "The user has uploaded a large presentation that was reviewed in parts. "
+    system_prompt += "Combine the findings from each part below into a single, comprehensive answer. "
+    system_prompt += "Ignore parts that found no relevant content, and mention slide numbers when referencing specific slides.\n\n"
+    system_prompt += f"FINDINGS BY PART:\n{findings}"
+    async for piece in _stream_complete(client, semaphore, system_prompt, user_message):
+        yield piece
+
+async def _generate_response(client, user_message, document_context, document_hash, doc_tokens, slide_records, slide_summaries, slide_tokens):
+    """Build the prompt for the document and stream a response from the model"""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    system_prompt = "You are a helpful AI assistant specialized in analyzing presentations and documents. "
+    
+    if document_context:
+        # Check token count and implement smart chunking
+        if doc_tokens > CONTEXT_TOKEN_LIMIT:
+            # Use smart content selection
+            chunks = get_relevant_slides_cached(document_hash, user_message, slide_records, slide_summaries, slide_tokens)
+            if not chunks:
+                # Not a presentation, so there are no slides to select from
+                chunks = [document_context]
+            
+            if len(chunks) > 1:
+                async for piece in _map_reduce_chunks(client, semaphore, user_message, chunks):
+                    yield piece
+                return
+            
+            relevant_content = chunks[0]
+            
+            system_prompt += "The user has uploaded a large presentation. "
+            system_prompt += "You have access to relevant slide content based on their question. "
+            system_prompt += "If they ask about specific slides, provide detailed information from those slides. "
+            system_prompt += "If they ask general questions, provide a comprehensive overview based on the available content.\n\n"
+            system_prompt += f"RELEVANT PRESENTATION CONTENT:\n{relevant_content}\n\n"
+            
+            # Add note about full presentation
+            system_prompt += "NOTE: This is a large presentation. If you need information from other slides, ask the user to specify which slides they're interested in.\n\n"
+            
+            # Add debugging info for development
+            if "slide" in user_message.lower():
+                system_prompt += "IMPORTANT: The user is asking about a specific slide. Make sure to provide comprehensive details from the slide content above. Look for all text, tables, and content within that slide.\n\n"
+        else:
+            system_prompt += f"Here is the content from the user's uploaded document:\n{document_context}\n\n"
+        
+        system_prompt += "Please provide detailed, accurate responses about the document content. "
+        system_prompt += "When referencing specific slides, mention the slide number. "
+        system_prompt += "If asked about specific details, provide comprehensive information from the relevant slides."
+    else:
+        system_prompt += "Please help the user with their questions."
+    
+    async for piece in _stream_complete(client, semaphore, system_prompt, user_message):
+        yield piece
+
+async def embed_text(client, text):
+    """Get an L2-normalized embedding vector for the given text"""
+    response = await client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+    embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
+    return embedding / np.linalg.norm(embedding)
+
+async def chat_with_ai_stream(client, user_message, document_context="", cache=None, slide_records=None,
+                              slide_summaries=None, doc_tokens=None, slide_tokens=None, document_hash=None):
+    """Stream a response from OpenAI with smart content management for large presentations"""
+    try:
+        if document_hash is None:
+            document_hash = hash_document(document_context)
+        if slide_records is None:
+            slide_records = []
+        if slide_summaries is None:
+            slide_summaries = create_slide_summaries(slide_records)
+        if doc_tokens is None:
+            doc_tokens = count_tokens(document_context)
+        if slide_tokens is None:
+            slide_tokens = [count_tokens(record.to_text()) for record in slide_records]
+        
+        response_stream = _generate_response(
+            client, user_message, document_context, document_hash, doc_tokens, slide_records, slide_summaries, slide_tokens
+        )
         
-        return response.choices[0].message.content
+        if cache is None:
+            async for piece in response_stream:
+                yield piece
+            return
+        
+        # Reuse the answer to a semantically similar question about the same document
+        question_numbers = QUESTION_NUMBER_RE.findall(user_message)
+        embedding = await embed_text(client, user_message)
+        cached_response = cache.lookup(document_hash, question_numbers, embedding)
+        if cached_response is not None:
+            yield cached_response
+            return
+        
+        pieces = []
+        async for piece in response_stream:
+            pieces.append(piece)
+            yield piece
+        cache.insert(document_hash, question_numbers, embedding, "".join(pieces))
     except Exception as e:
-        return f"Error: {str(e)}"
+        yield f"Error: {str(e)}"
+
+async def _stream_chat(api_key, user_message, document_context, cache=None, slide_records=None, slide_summaries=None,
+                       doc_tokens=None, slide_tokens=None, document_hash=None):
+    """Open an async OpenAI client for the duration of a single streamed chat turn"""
+    async with get_openai_client(api_key) as client:
+        async for piece in chat_with_ai_stream(
+            client, user_message, document_context, cache, slide_records, slide_summaries, doc_tokens, slide_tokens,
+            document_hash
+        ):
+            yield piece
+
+def iterate_async(async_generator):
+    """Drive an async generator from synchronous code, such as st.write_stream"""
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(async_generator.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(async_generator.aclose())
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+def spin_until_first(pieces, message="Thinking..."):
+    """Show a spinner until the first piece of a streamed response arrives"""
+    with st.spinner(message):
+        first_piece = next(pieces, None)
+    if first_piece is None:
+        return
+    yield first_piece
+    yield from pieces
+
+# Load the tokenizer at startup so the first upload doesn't pay for it;
+# token counts fall back to an estimate if it can't be loaded
+get_token_encoding()
+
+# Initialize the semantic response cache
+if "semantic_cache" not in st.session_state:
+    st.session_state.semantic_cache = SemanticCache(os.getenv("SEMANTIC_CACHE_PATH"))
 
 # Main app layout
 st.title("📄 AI Document Chat")
@@ -449,25 +728,49 @@ with col1:
     )
     
     if uploaded_file is not None:
+        # Read the file content
+        file_content = uploaded_file.getvalue()
+        content_hash = hashlib.blake2b(file_content, digest_size=16).hexdigest()
+        
         # Show processing indicator for large files
-        file_size_mb = len(uploaded_file.read()) / (1024 * 1024)
-        uploaded_file.seek(0)  # Reset file pointer
+        file_size_mb = len(file_content) / (1024 * 1024)
         
         if file_size_mb > 10:  # Large file
             st.info(f"📊 Processing large file ({file_size_mb:.1f} MB). This may take a moment...")
         
-        # Read the file content
-        file_content = uploaded_file.read()
+        # Reuse the text of a file already processed in this session
+        document_key = (content_hash, uploaded_file.name)
+        processed = st.session_state.document_cache.get(document_key)
         
-        # Show progress for PowerPoint files
-        if uploaded_file.name.endswith('.pptx'):
-            with st.spinner("🔍 Extracting content from PowerPoint slides..."):
-                document_text = process_document(file_content, uploaded_file.name)
-        else:
-            document_text = process_document(file_content, uploaded_file.name)
+        if processed is None:
+            # Show progress for PowerPoint files
+            if uploaded_file.name.endswith('.pptx'):
+                with st.spinner("🔍 Extracting content from PowerPoint slides..."):
+                    processed = process_document_cached(content_hash, uploaded_file.name, file_content)
+            else:
+                processed = process_document_cached(content_hash, uploaded_file.name, file_content)
+            
+            if processed[0]:
+                # Keep only the most recently processed documents
+                if len(st.session_state.document_cache) >= DOCUMENT_CACHE_SIZE:
+                    del st.session_state.document_cache[next(iter(st.session_state.document_cache))]
+                st.session_state.document_cache[document_key] = processed
+        
+        document_text, slide_records = processed
         
         if document_text:
-            st.session_state.document_content = document_text
+            if document_text != st.session_state.document_content:
+                st.session_state.document_content = document_text
+                # Hash the text once so chat turns can key cached answers without rehashing
+                st.session_state.document_hash = hash_document(document_text)
+                # Summarize the slides once, when the document is loaded
+                st.session_state.slide_records = slide_records
+                st.session_state.slide_summaries = create_slide_summaries(st.session_state.slide_records)
+                # Count tokens once so chat turns can budget prompts exactly
+                st.session_state.doc_tokens = count_tokens(document_text)
+                st.session_state.slide_tokens = [
+                    count_tokens(record.to_text()) for record in st.session_state.slide_records
+                ]
             
             # Show success with file stats
             content_length = len(document_text)
@@ -475,12 +778,11 @@ with col1:
             
             # Show document statistics
             if uploaded_file.name.endswith('.pptx'):
-                # Extract slide count from the processed content
-                slide_count = document_text.count("=== SLIDE")
+                slide_count = len(st.session_state.slide_records)
                 st.info(f"📊 Extracted content from {slide_count} slides ({content_length:,} characters)")
                 
                 # Show helpful tips for large presentations
-                if content_length > 50000:  # Large presentation
+                if st.session_state.doc_tokens > CONTEXT_TOKEN_LIMIT:  # Too large to send whole
                     st.warning("⚠️ **Large Presentation Detected**")
                     st.markdown("""
                     **Tips for analyzing large presentations:**
@@ -505,6 +807,11 @@ with col1:
     if st.session_state.document_content:
         if st.button("🗑️ Clear Document"):
             st.session_state.document_content = ""
+            st.session_state.slide_records = []
+            st.session_state.slide_summaries = []
+            st.session_state.doc_tokens = 0
+            st.session_state.slide_tokens = []
+            st.session_state.document_hash = ""
             st.session_state.messages = []
             st.rerun()
 
@@ -516,14 +823,12 @@ with col2:
     if not st.session_state.api_key:
         st.warning("⚠️ Please enter your OpenAI API key in the left panel to start chatting.")
     else:
-        # Initialize OpenAI client
-        client = get_openai_client(st.session_state.api_key)
-        
-        if client is None:
+        # Validate the OpenAI API key
+        if not validate_api_key(st.session_state.api_key):
             st.error("❌ Unable to connect to OpenAI API. Please check your API key.")
         else:
             # Show helpful message for large presentations
-            if st.session_state.document_content and len(st.session_state.document_content) > 50000:
+            if st.session_state.document_content and st.session_state.doc_tokens > CONTEXT_TOKEN_LIMIT:
                 st.info("💡 **Large presentation loaded!** For best results, ask about specific slides or sections (e.g., 'What's on slide 15?' or 'Summarize the first 10 slides').")
             
             # Display chat messages
@@ -542,13 +847,17 @@ with col2:
                 
                 # Get AI response
                 with st.chat_message("assistant"):
-                    with st.spinner("Thinking..."):
-                        response = chat_with_ai(
-                            client, 
-                            prompt, 
-                            st.session_state.document_content
-                        )
-                    st.markdown(response)
+                    response = st.write_stream(spin_until_first(iterate_async(_stream_chat(
+                        st.session_state.api_key,
+                        prompt,
+                        st.session_state.document_content,
+                        st.session_state.semantic_cache,
+                        st.session_state.slide_records,
+                        st.session_state.slide_summaries,
+                        st.session_state.doc_tokens,
+                        st.session_state.slide_tokens,
+                        st.session_state.document_hash
+                    ))))
                 
                 # Add assistant response to chat history
                 st.session_state.messages.append({"role": "assistant", "content": response})